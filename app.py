@@ -1,17 +1,292 @@
 from flask import Flask, Response, render_template, request, jsonify
 import cv2
+import numpy as np
 import serial
 import json
 import time
 import os
+import io
+import threading
+import queue
+import collections
+import logging
+import logging.handlers
+from functools import lru_cache
+
+try:
+    from picamera2 import Picamera2
+    from picamera2.encoders import MJPEGEncoder
+    from picamera2.outputs import FileOutput
+except ImportError:
+    Picamera2 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420, TJFLAG_FASTDCT
+    _tj = TurboJPEG()
+except (ImportError, RuntimeError):
+    _tj = None
 
 app = Flask(__name__)
+log = logging.getLogger(__name__)
+
+
+# 📝 Logging goes through a queue so the capture and serial threads
+# never block on console I/O
+def setup_logging():
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+    logging.handlers.QueueListener(log_queue, handler).start()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+
+
+setup_logging()
  
  
 # 🎥 Camera setup
+JPEG_QUALITY = 70
+# Baseline, non-optimized, 4:2:0 JPEGs are the cheapest to encode for a live view
+_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY,
+                cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+                cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):  # OpenCV >= 4.5.5
+    _JPEG_PARAMS += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420]
+# Largest stream size, e.g. STREAM_SIZE=640x480; viewers on the control page
+# are usually under 400 px wide, so don't encode pixels nobody will see.
+# Frames we re-encode anyway are shrunk to fit it, keeping their aspect ratio
+FRAME_WIDTH, FRAME_HEIGHT = (int(n) for n in os.environ.get("STREAM_SIZE", "480x360").split("x"))
+TARGET_FPS = 30
+# Forward the webcam's own JPEGs instead of decoding and re-encoding them, as
+# long as its mode is within RAW_MAX_SCALE of the stream size (e.g. 640x480
+# for 480x360); passing those through is cheaper than decode+resize+encode
+RAW_MJPEG = True
+RAW_MAX_SCALE = 1.5
+JPEG_SOI = b'\xff\xd8\xff'
+
+
+class LatestFrame(io.BufferedIOBase):
+    """One-slot, latest-wins JPEG buffer shared by every /video_feed client."""
+
+    def __init__(self):
+        self.buf = None
+        self.seq = 0
+        self.viewers = 0
+        self.cond = threading.Condition()
+
+    def set(self, buf):
+        with self.cond:
+            self.buf = buf
+            self.seq += 1
+            self.cond.notify_all()
+
+    def wait_newer(self, seq, timeout=None):
+        """Wait for a frame newer than `seq` and return (seq, buf), or (seq, None) on timeout."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq != seq, timeout):
+                return seq, None
+            return self.seq, self.buf
+
+    # picamera2's FileOutput calls write() with each hardware-encoded JPEG
+    write = set
+
+
+latest = LatestFrame()
+
+
+def encode_jpeg(frame):
+    """Encode a BGR frame to a bytes-like JPEG, using libjpeg-turbo directly when available."""
+    if _tj is not None:
+        return _tj.encode(frame, quality=JPEG_QUALITY,
+                          jpeg_subsample=TJSAMP_420, flags=TJFLAG_FASTDCT)
+    ret, buffer = cv2.imencode('.jpg', frame, _JPEG_PARAMS)
+    # imencode hands back a fresh array every call, so expose it without copying
+    return memoryview(buffer).cast('B')
+
+
+def frame_to_jpeg(frame):
+    """Return JPEG bytes for a retrieved frame, passing camera MJPEG through untouched.
+
+    Returns None for a raw buffer that is not a JPEG, which the caller treats
+    as a failed read.
+    """
+    if frame.ndim < 3:
+        # Copy out: `frame` is the capture buffer and is overwritten by the next retrieve()
+        data = frame.tobytes()
+        if data.startswith(JPEG_SOI):
+            return data
+        return None
+    # Since this frame is re-encoded anyway, shrink it to fit the stream
+    # size; keep the aspect ratio and never upscale
+    height, width = frame.shape[:2]
+    scale = min(FRAME_WIDTH / width, FRAME_HEIGHT / height)
+    if scale < 1:
+        frame = cv2.resize(frame, (round(width * scale), round(height * scale)),
+                           interpolation=cv2.INTER_AREA)
+    return encode_jpeg(frame)
+
+
+def open_camera():
+    """Open the USB camera, preferring the V4L2 backend on Linux."""
+    if os.name != "nt":
+        camera = cv2.VideoCapture(0, cv2.CAP_V4L2)
+        if camera.isOpened():
+            return camera
+        camera.release()
+    return cv2.VideoCapture(0)
+
+
+def get_camera():
+    camera = open_camera()
+    # Ask the webcam for compressed MJPG at the stream size so the driver
+    # scales for us and does not hand us YUYV that has to be converted
+    camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    camera.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+    camera.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+    # Only skip OpenCV's decode if the driver really agreed to MJPG at or
+    # near the stream size; raw YUYV buffers would be useless to us, and a
+    # much larger mode is worth decoding and shrinking in frame_to_jpeg()
+    if (RAW_MJPEG
+            and int(camera.get(cv2.CAP_PROP_FOURCC)) == cv2.VideoWriter_fourcc(*'MJPG')
+            and camera.get(cv2.CAP_PROP_FRAME_WIDTH) <= FRAME_WIDTH * RAW_MAX_SCALE
+            and camera.get(cv2.CAP_PROP_FRAME_HEIGHT) <= FRAME_HEIGHT * RAW_MAX_SCALE):
+        camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    # Not every backend supports this; grab_latest() drains the queue anyway
+    try:
+        camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    except cv2.error:
+        pass
+    return camera
+
+
+# A grab that returns faster than this came out of the driver's queue
+# rather than from the sensor, i.e. the frame is stale
+STALE_GRAB_SECONDS = 0.005
+MAX_STALE_GRABS = 4
+
+
+def grab_latest(camera):
+    """Grab the newest frame, skipping ones the driver queued while we were encoding."""
+    for _ in range(MAX_STALE_GRABS):
+        start = time.monotonic()
+        if not camera.grab():
+            return False
+        if time.monotonic() - start > STALE_GRAB_SECONDS:
+            break
+    return True
+
+
+# The VideoCapture is opened once and reused; it is only reopened after
+# MAX_CONSECUTIVE_FAILURES reads in a row fail
+_CAM = None
+_CAM_LOCK = threading.Lock()
+MAX_CONSECUTIVE_FAILURES = 5
+
+
+def cam():
+    global _CAM
+    with _CAM_LOCK:
+        if _CAM is None or not _CAM.isOpened():
+            _CAM = get_camera()
+        return _CAM
+
+
+def release_camera():
+    global _CAM
+    with _CAM_LOCK:
+        if _CAM is not None:
+            _CAM.release()
+        _CAM = None
+
+
+def capture_loop():
+    """Grab and encode frames from the USB/V4L2 camera into `latest`, forever."""
+    consecutive_failures = 0
+    reopens = 0
+    # retrieve() decodes into this array in place once it has the right shape,
+    # instead of allocating a new ~900 KB frame every time
+    frame = None
+    # Pace against a wall-clock schedule rather than sleeping a fixed time per frame
+    frame_interval = 1.0 / TARGET_FPS
+    next_t = time.monotonic()
+    while True:
+        camera = None
+        # An exception here must not kill the only capture thread; it counts
+        # as a failed read so a broken camera still gets reopened
+        try:
+            camera = cam()
+            success = grab_latest(camera)
+            # Keep grabbing so the driver queue stays fresh, but only decode
+            # and encode when someone is watching; retrieve() is where the
+            # MJPEG decode happens
+            if success and latest.viewers:
+                success, frame = camera.retrieve(frame)
+                jpeg = frame_to_jpeg(frame) if success else None
+                success = jpeg is not None
+                if success:
+                    latest.set(jpeg)
+        except Exception:
+            if consecutive_failures == 0:
+                log.warning("Capture failed", exc_info=True)
+            else:
+                log.debug("Capture failed", exc_info=True)
+            success = False
+        if not success:
+            consecutive_failures += 1
+            log.debug("Frame read failed (%d in a row)", consecutive_failures)
+            if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                reopens += 1
+                if reopens % 30 == 1:
+                    log.warning("Camera keeps failing, reopening it (attempt %d)", reopens)
+                release_camera()
+                consecutive_failures = 0
+            time.sleep(0.1 if camera is not None and camera.isOpened() else 1)
+            continue
+        consecutive_failures = 0
+        reopens = 0
+        next_t += frame_interval
+        delay = next_t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Slower than TARGET_FPS: run at encoder speed and restart the schedule
+            next_t = time.monotonic()
+
+
+# On a Raspberry Pi, let the VideoCore MJPEG encoder do the JPEG work;
+# otherwise a single background thread captures for all viewers
+camera_started = False
+if Picamera2 is not None:
+    try:
+        picam2 = Picamera2()
+        # The ISP scales to the stream size and outputs YUV420, the JPEG
+        # encoder's native input, so no RGB frame is produced or converted
+        picam2.configure(picam2.create_video_configuration(
+            main={"size": (FRAME_WIDTH, FRAME_HEIGHT), "format": "YUV420"},
+            controls={"FrameRate": TARGET_FPS}))
+        picam2.start_recording(MJPEGEncoder(), FileOutput(latest))
+        camera_started = True
+        log.info("Picamera2 hardware MJPEG encoder started")
+    except Exception as e:
+        log.warning("Picamera2 setup failed: %s", e)
+
+if not camera_started:
+    threading.Thread(target=capture_loop, name="CaptureThread", daemon=True).start()
 
 
 # 🔌 Arduino serial setup (adjust COM port & baudrate)
+# Stick updates give up after 100 ms instead of queueing behind a stalled USB
+# link; anything else gets a timeout sized to how long the line takes to send
+SERIAL_WRITE_TIMEOUT = 0.1
+
 try:
     if os.name == "nt":
         arduino = serial.Serial("COM1", 9600, timeout=1)
@@ -19,27 +294,223 @@ try:
         arduino = serial.Serial("/dev/ttyACM0", 9600, timeout=1)
     time.sleep(2)
     arduino.reset_input_buffer()
-    print("Arduino connected")
+    log.info("Arduino connected")
 except Exception as e:
-    print("Arduino connection failed:", e)
+    log.warning("Arduino connection failed: %s", e)
     arduino = None
 
-def generate_frames():
-    camera = cv2.VideoCapture(0)
+# Each JSON line goes out as one write(); Flask serves requests on several threads
+arduino_lock = threading.Lock()
+
+
+def encode_command(data):
+    """Serialize `data` as the newline-terminated JSON line the Arduino sketch reads."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(data).encode("utf-8") + b"\n"
+
+
+def read_json():
+    """Parse the request body as JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(request.get_data(cache=False))
+    return request.get_json()
+
+
+@lru_cache(maxsize=256)
+def _encode_items(items):
+    return encode_command({k: v for k, _, v in items})
+
+
+def encode_joystick(data):
+    """Like encode_command, but memoized since joystick payloads repeat constantly."""
+    try:
+        # Key on each value's type too: 1, 1.0 and True hash equal but encode differently
+        return _encode_items(tuple((k, type(v), v) for k, v in data.items()))
+    except (AttributeError, TypeError):
+        # Not a dict, or it holds unhashable values such as nested lists
+        return encode_command(data)
+
+
+def line_write_timeout(payload):
+    """Time to send `payload` at the port's baud rate (10 bits per byte), plus a second."""
+    return len(payload) * 10 / arduino.baudrate + 1.0
+
+
+def write_to_arduino(payload, write_timeout=None):
+    if arduino is None:
+        raise RuntimeError("Arduino not connected")
+    if write_timeout is None:
+        write_timeout = line_write_timeout(payload)
+    with arduino_lock:
+        if arduino.write_timeout != write_timeout:
+            arduino.write_timeout = write_timeout
+        try:
+            arduino.write(payload)
+        except serial.SerialTimeoutException:
+            # Drop what is still unsent, then end the line: the prefix that
+            # already went out becomes one bad line the sketch discards,
+            # instead of swallowing the next command too
+            arduino.reset_output_buffer()
+            try:
+                arduino.write(b"\n")
+            except serial.SerialTimeoutException:
+                pass
+            raise
+
+
+def send_to_arduino(data):
+    """Write `data` to the Arduino right away, on the calling thread."""
+    write_to_arduino(encode_command(data))
+
+
+# Everything from /joystick goes through one FIFO drained by a single writer
+# thread, so a slow USB flush never stalls the client and commands keep their
+# order. Stick axis updates are latest-wins; discrete actions are never dropped
+JOYSTICK_MAX_AXIS_UPDATES = 8
+ACTION_WAIT_TIMEOUT = 5.0
+QUEUE_LOG_EVERY = 500
+
+
+class SerialLine:
+    """One queued line; `done` is set once a never-drop line has been written."""
+
+    def __init__(self, payload, droppable):
+        self.payload = payload
+        self.done = None if droppable else threading.Event()
+        self.error = None
+
+
+class JoystickQueue:
+    """FIFO for the serial writer that drops the oldest axis update when too many wait."""
+
+    def __init__(self, max_axis_updates):
+        self.items = collections.deque()
+        self.max_axis_updates = max_axis_updates
+        self.axis_updates = 0
+        self.cond = threading.Condition()
+
+    def put(self, line):
+        with self.cond:
+            if line.done is None:
+                if self.axis_updates >= self.max_axis_updates:
+                    for i, queued in enumerate(self.items):
+                        if queued.done is None:
+                            del self.items[i]
+                            self.axis_updates -= 1
+                            break
+                self.axis_updates += 1
+            self.items.append(line)
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.items)
+            line = self.items.popleft()
+            if line.done is None:
+                self.axis_updates -= 1
+            return line
+
+    def qsize(self):
+        with self.cond:
+            return len(self.items)
+
+
+joystick_queue = JoystickQueue(JOYSTICK_MAX_AXIS_UPDATES)
+
+
+def queue_joystick(data):
+    """Queue a stick axis update, dropping the oldest one if the writer is behind."""
+    if arduino is None:
+        raise RuntimeError("Arduino not connected")
+    joystick_queue.put(SerialLine(encode_joystick(data), droppable=True))
+
+
+def send_joystick_action(data):
+    """Queue a discrete command behind earlier stick updates and wait until it is written."""
+    if arduino is None:
+        raise RuntimeError("Arduino not connected")
+    line = SerialLine(encode_command(data), droppable=False)
+    joystick_queue.put(line)
+    if not line.done.wait(ACTION_WAIT_TIMEOUT):
+        raise RuntimeError("Timed out waiting for the Arduino")
+    if line.error is not None:
+        raise line.error
+
+
+def serial_writer_loop():
+    sent = 0
     while True:
-        success, frame = camera.read()
-        if not success:
-            break
-        else:
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+        line = joystick_queue.get()
+        try:
+            if line.done is None:
+                write_to_arduino(line.payload, SERIAL_WRITE_TIMEOUT)
+            else:
+                write_to_arduino(line.payload)
+        except Exception as e:
+            line.error = e
+            log.warning("Joystick write failed: %s", e)
+        finally:
+            if line.done is not None:
+                line.done.set()
+        sent += 1
+        if sent % QUEUE_LOG_EVERY == 0:
+            log.info("Joystick queue depth: %d", joystick_queue.qsize())
+
+
+if arduino is not None:
+    threading.Thread(target=serial_writer_loop, name="SerialWriter", daemon=True).start()
+
+
+_HDR = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+
+
+def mjpeg_wrap(frame_bytes):
+    """Build one multipart/x-mixed-replace part as a single bytes object."""
+    return b''.join((_HDR, str(len(frame_bytes)).encode(), b'\r\n\r\n',
+                     frame_bytes, b'\r\n'))
+
+
+def _placeholder_jpeg(text):
+    frame = np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), np.uint8)
+    cv2.putText(frame, text, (50, FRAME_HEIGHT // 2), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+    return cv2.imencode('.jpg', frame, _JPEG_PARAMS)[1].tobytes()
+
+
+# Encoded and wrapped once at startup and shown whenever the camera goes quiet
+_NO_CAM_JPEG = _placeholder_jpeg("Camera not available")
+_NO_CAM_PART = mjpeg_wrap(_NO_CAM_JPEG)
+NO_FRAME_TIMEOUT = 2.0
+PLACEHOLDER_INTERVAL = 0.2
+
+
+def generate_frames():
+    # Always send the newest frame: if yielding blocked on a slow client,
+    # the frames encoded meanwhile are skipped rather than queued
+    with latest.cond:
+        latest.viewers += 1
+        last_seq = latest.seq
+    try:
+        timeout = NO_FRAME_TIMEOUT
+        while True:
+            last_seq, frame = latest.wait_newer(last_seq, timeout)
+            if frame is None:
+                # The wait doubles as the placeholder's frame pacing, and a
+                # real frame ends it as soon as the camera comes back
+                yield _NO_CAM_PART
+                timeout = PLACEHOLDER_INTERVAL
+                continue
+            timeout = NO_FRAME_TIMEOUT
+            yield mjpeg_wrap(frame)
+    finally:
+        with latest.cond:
+            latest.viewers -= 1
 
 @app.route('/video_feed')
 def video_feed():
     return Response(generate_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+                    mimetype='multipart/x-mixed-replace; boundary=frame',
+                    direct_passthrough=True)
 
 @app.route('/')
 def index():
@@ -53,12 +524,15 @@ def filo():
 @app.route('/joystick', methods=['POST'])
 def joystick():
     try:
-        data = request.get_json()
-        print("Received joystick data:", data)
+        data = read_json()
+        log.debug("Received joystick data: %s", data)
 
-        # Convert dict -> JSON string for Arduino
-        command = json.dumps(data) + "\n"
-        arduino.write(command.encode("utf-8"))
+        # Discrete commands (takeoff/land/return_home) must never be dropped
+        # or overtaken by stick updates that were queued before them
+        if isinstance(data, dict) and "action" in data:
+            send_joystick_action(data)
+        else:
+            queue_joystick(data)
 
         return jsonify({"status": "ok", "sent": data})
     except Exception as e:
@@ -68,15 +542,15 @@ def joystick():
 @app.route('/run', methods=['POST'])
 def run_program():
     try:
-        program = request.json
-        print("Received Blockly program:", program)
+        program = read_json()
+        log.info("Received Blockly program: %s", program)
 
-        command = json.dumps(program) + "\n"
-        arduino.write(command.encode("utf-8"))
+        send_to_arduino(program)
 
         return jsonify({"status": "ok", "sent": program})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development only; see gunicorn.conf.py for running on the robot
+    app.run(host='0.0.0.0', port=5000, threaded=True)
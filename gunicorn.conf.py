@@ -0,0 +1,10 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app
+bind = "0.0.0.0:5000"
+
+# A single process owns the camera and the Arduino serial port; the capture
+# and serial writer threads start when app.py is imported in that worker
+workers = 1
+
+# Each open /video_feed holds one thread, so leave room for /joystick and /run
+worker_class = "gthread"
+threads = 8